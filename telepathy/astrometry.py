@@ -1,34 +1,49 @@
-import requests
+import orjson
+import os
 import numpy as np
+import random
 import time
 import rawpy
-import re
+import sep
+import shutil
 import subprocess
+import tempfile
 from astropy.io import fits
-from client import Client
+from typing import Optional
+from client import Client, _get_upload_args
 
 TIMEOUT = 600
+MAX_SOURCES = 300
 url = "http://nova.astrometry.net/api/"
 
 class UploadError(Exception):
     pass
 
 
-def get_results(jobid):
-    img = requests.get(f"http://nova.astrometry.net/api/jobs/{jobid}/info/").json()
+def get_json(client: Client, endpoint: str):
+    r = client.http.get(url + endpoint)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+def get_results(img: dict):
     ra = img["calibration"]["ra"]
     dec = img["calibration"]["dec"]
     print(f"RA: {ra}, DEC: {dec}")
 
-    return {"ra": img["calibration"]["ra"], "dec": img["calibration"]["dec"]}
+    # nova doesn't report the match log-odds, only that it cleared its own threshold
+    return {"ra": img["calibration"]["ra"], "dec": img["calibration"]["dec"], "logodds": None}
 
 def convert_to_fits(img_filename, output):
+    # Take one green photosite of each 2x2 Bayer cell straight from the raw
+    # sensor data; solving only needs a mono star field, not a demosaiced image
     with rawpy.imread(img_filename) as image:
-        image_array = image.postprocess()
+        green = image.color_desc.index(b"G")
+        row, col = np.argwhere(image.raw_pattern == green)[0]
+        img = image.raw_image_visible[row::2, col::2].copy()
 
-    img = image_array[:, :, 1]
     newhdu = fits.PrimaryHDU(img)
-    newhdu.writeto(output, overwrite=True)
+    newhdu.writeto(output, overwrite=True, output_verify="ignore")
     print("Image successfully converted to FITS")
 
 
@@ -40,50 +55,72 @@ def solve_web(img_filename: str, api_key: str, ra: float, dec: float, radius: fl
         convert_to_fits(img_filename, "output.fits")
         img_filename = "output.fits"
 
+    return submit_web(api_key, img_filename, scale_units="degwidth", center_ra=ra, center_dec=dec,
+                      radius=radius)
+
+
+def solve_web_sources(xs: np.ndarray, ys: np.ndarray, width: int, height: int, api_key: str, ra: float,
+                      dec: float, radius: float):
+    """Solve on nova from a flux-sorted star list, uploading kilobytes instead of the image"""
+    # astrometry.net pixel coordinates are 1-indexed, sep's are 0-indexed
+    return submit_web(api_key, None, x=(xs + 1).tolist(), y=(ys + 1).tolist(), image_width=width,
+                      image_height=height, scale_units="degwidth", center_ra=ra, center_dec=dec, radius=radius)
+
+
+def submit_web(api_key: str, img_filename: Optional[str], **upload_kwargs):
     c = Client(apiurl=url)
-    c.login(api_key)
-    subid = None
-
-    upload_kwargs = {"scale_units": "degwidth", "center_ra": ra, "center_dec": dec, "radius": radius}
-
-    # Attempt to upload image twice
-    for i in range(2):
-        upres = c.upload(img_filename, **upload_kwargs)
-        if upres["status"] == "success":
-            subid = upres["subid"]
-            print(f"Image uploaded successfully\nSubmission ID: {subid}")
-            break
-        else:
-            print("Image upload failed, trying again...")
-
-    if subid is None:
-        raise UploadError("Image failed to upload.")
-
-    print("Awaiting job submission...")
-    start = time.time()
-    while True:
-        if time.time() - start > TIMEOUT:
-            raise TimeoutError
-
-        jobid_list = requests.get(f"http://nova.astrometry.net/api/submissions/{subid}").json()["jobs"]
-        if not jobid_list or not jobid_list[0]:
-            time.sleep(1)
-            continue
-
-        jobid = jobid_list[0]
-        status = requests.get(f"http://nova.astrometry.net/api/jobs/{jobid}").json()["status"]
-
-        if status == "solving":
-            time.sleep(1)
-            continue
-
-        if status == "success":
-            print(f"Job completed in {round(time.time() - start, 1)} seconds")
-            return get_results(jobid)
-
-        else:
-            print(f"Job failed in {round(time.time() - start, 1)} seconds")
-            return None
+    try:
+        c.login(api_key)
+        subid = None
+
+        upload_args = _get_upload_args(**upload_kwargs)
+
+        # Attempt to upload image twice
+        for i in range(2):
+            upres = c.upload(img_filename, upload_args)
+            if upres["status"] == "success":
+                subid = upres["subid"]
+                print(f"Image uploaded successfully\nSubmission ID: {subid}")
+                break
+            else:
+                print("Image upload failed, trying again...")
+
+        if subid is None:
+            raise UploadError("Image failed to upload.")
+
+        print("Awaiting job submission...")
+        start = time.time()
+        # Poll over the client's keep-alive session, quickly at first and
+        # backing off (with jitter) while the job runs
+        delay = 0.25
+        jobid = None
+        while True:
+            if time.time() - start > TIMEOUT:
+                raise TimeoutError
+
+            # Only the submission knows the job ID; once we have it, the job
+            # info endpoint carries both the status and the calibration
+            if jobid is None:
+                jobid_list = get_json(c, f"submissions/{subid}")["jobs"]
+                if jobid_list and jobid_list[0]:
+                    jobid = jobid_list[0]
+
+            if jobid is not None:
+                info = get_json(c, f"jobs/{jobid}/info/")
+                status = info["status"]
+
+                if status == "success":
+                    print(f"Job completed in {round(time.time() - start, 1)} seconds")
+                    return get_results(info)
+
+                elif status != "solving":
+                    print(f"Job failed in {round(time.time() - start, 1)} seconds")
+                    return None
+
+            time.sleep(delay + random.uniform(0, 0.1))
+            delay = min(delay * 1.5, 5.0)
+    finally:
+        c.http.close()  # Each solve gets its own session; release its pooled socket
 
 def solve_local(img_filename: str, ra: float, dec: float, radius: float = 10):
     name, ext = img_filename.split(".")  # Get file extension
@@ -93,34 +130,61 @@ def solve_local(img_filename: str, ra: float, dec: float, radius: float = 10):
         convert_to_fits(img_filename, f"{name}.fits")
         img_filename = f"{name}.fits"
 
-    subprocess.run(f"solve-field --ra {ra} --dec {dec} --radius {radius} --no-remove-lines --uniformize 0 --no-plots "
-                   "--crpix-center --match none --rdls none --new-fits none --corr none --index-xyls none --solved "
-                   f"none {img_filename}", shell=True)
-    subprocess.run(["rm", "*.axy"])
-    result = read_wcs(f"{name}.wcs")
-    subprocess.run(["rm", "*.wcs"])
-
+    # Keep every solve-field artifact in a private directory so concurrent
+    # solves can't collide and nothing needs to be globbed up afterwards
+    tmp = tempfile.mkdtemp(prefix="tele_")
+    try:
+        return run_solve_field(img_filename, tmp, ra, dec, radius)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def solve_sources(xs: np.ndarray, ys: np.ndarray, flux: np.ndarray, width: int, height: int, ra: float, dec: float,
+                  radius: float, fov_width: float):
+    """Solve from a flux-sorted star list instead of an image file"""
+    tmp = tempfile.mkdtemp(prefix="tele_")
+    try:
+        # FITS pixel coordinates are 1-indexed, sep's are 0-indexed
+        xylist = fits.BinTableHDU.from_columns([
+            fits.Column(name="X", format="D", array=xs + 1),
+            fits.Column(name="Y", format="D", array=ys + 1),
+            fits.Column(name="FLUX", format="D", array=flux),
+        ])
+        xylist.writeto(f"{tmp}/sources.xyls")
+
+        # Bracketing the image scale lets solve-field skip index files that can't match
+        return run_solve_field(f"{tmp}/sources.xyls", tmp, ra, dec, radius,
+                               "--width", str(width), "--height", str(height), "--scale-units", "degwidth",
+                               "--scale-low", str(fov_width * 0.8), "--scale-high", str(fov_width * 1.2))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def run_solve_field(input_path: str, out_dir: str, ra: float, dec: float, radius: float, *extra_args: str):
+    subprocess.run(["solve-field", "--dir", out_dir, "--out", "job", "--ra", str(ra), "--dec", str(dec),
+                    "--radius", str(radius), "--no-remove-lines", "--uniformize", "0", "--no-plots",
+                    "--crpix-center", "--rdls", "none", "--new-fits", "none", "--corr", "none",
+                    "--index-xyls", "none", "--solved", "none", *extra_args, input_path], check=True)
+
+    # solve-field exits cleanly without writing a WCS when no field matches
+    if not os.path.exists(f"{out_dir}/job.wcs"):
+        return None
+    result = read_wcs(f"{out_dir}/job.wcs")
+    result["logodds"] = float(fits.getdata(f"{out_dir}/job.match", 1)["LOGODDS"][0])
     return result
 
 
+def extract_sources(image: np.ndarray, max_sources: int = MAX_SOURCES) -> tuple:
+    """Detect stars in an image, returning x, y and flux arrays sorted brightest first"""
+    data = np.ascontiguousarray(image, dtype=np.float32)
+    bkg = sep.Background(data)
+    bkg.subfrom(data)
+    objects = sep.extract(data, 5.0, err=bkg.globalrms)
+
+    order = np.argsort(objects["flux"])[::-1][:max_sources]
+    return objects["x"][order], objects["y"][order], objects["flux"][order]
+
+
 def read_wcs(filepath: str):
-    with open(filepath) as f:
-        lines = f.read()
-
-    lines = [line.strip() for line in re.split("=|        ", lines)]
-    new_lines = []
-    for line in lines:
-        if "HISTORY" in line:
-            break
-        try:
-            end = line.index("/")
-            line = line[0:end].strip()
-        except ValueError:
-            line = line.strip()
-        new_lines.append(line)
-    new_lines = list(filter(None, new_lines))
-    wcs = {}
-    for i, j in zip(new_lines[0::2], new_lines[1::2]):
-        wcs[i] = j
-
-    return {"ra": float(wcs["CRVAL1"]), "dec": float(wcs["CRVAL2"])}
+    hdr = fits.getheader(filepath)
+    return {"ra": float(hdr["CRVAL1"]), "dec": float(hdr["CRVAL2"])}
@@ -1,8 +1,12 @@
-import json
+import io
+import logging
+import os
+import orjson
+import requests
 
-from urllib.parse import urlencode
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
 
 
 class MalformedResponse(Exception):
@@ -13,39 +17,69 @@ class RequestError(Exception):
     pass
 
 
+class _MultipartBody(object):
+    """File-like request body that streams the upload file between its multipart framing"""
+    chunk_size = 64 * 1024
+
+    def __init__(self, pre, f, post):
+        self._parts = [io.BytesIO(pre), f, io.BytesIO(post)]
+        self._len = len(pre) + os.fstat(f.fileno()).st_size - f.tell() + len(post)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
+_UPLOAD_SPEC = (
+    ('allow_commercial_use', 'd', str),
+    ('allow_modifications', 'd', str),
+    ('publicly_visible', 'y', str),
+    ('scale_units', None, str),
+    ('scale_type', None, str),
+    ('scale_lower', None, float),
+    ('scale_upper', None, float),
+    ('scale_est', None, float),
+    ('scale_err', None, float),
+    ('center_ra', None, float),
+    ('center_dec', None, float),
+    ('parity', None, int),
+    ('radius', None, float),
+    ('downsample_factor', None, int),
+    ('positional_error', None, float),
+    ('tweak_order', None, int),
+    ('crpix_center', None, bool),
+    ('invert', None, bool),
+    ('image_width', None, int),
+    ('image_height', None, int),
+    ('x', None, list),
+    ('y', None, list),
+    ('album', None, str),
+)
+
+
 def _get_upload_args(**kwargs):
-    args = {}
-    for key, default, typ in [('allow_commercial_use', 'd', str),
-                              ('allow_modifications', 'd', str),
-                              ('publicly_visible', 'y', str),
-                              ('scale_units', None, str),
-                              ('scale_type', None, str),
-                              ('scale_lower', None, float),
-                              ('scale_upper', None, float),
-                              ('scale_est', None, float),
-                              ('scale_err', None, float),
-                              ('center_ra', None, float),
-                              ('center_dec', None, float),
-                              ('parity', None, int),
-                              ('radius', None, float),
-                              ('downsample_factor', None, int),
-                              ('positional_error', None, float),
-                              ('tweak_order', None, int),
-                              ('crpix_center', None, bool),
-                              ('invert', None, bool),
-                              ('image_width', None, int),
-                              ('image_height', None, int),
-                              ('x', None, list),
-                              ('y', None, list),
-                              ('album', None, str),
-                              ]:
-        if key in kwargs:
-            val = kwargs.pop(key)
-            val = typ(val)
-            args.update({key: val})
-        elif default is not None:
-            args.update({key: default})
-    print('Upload args:', args)
+    args = {key: typ(kwargs[key]) if key in kwargs else default
+            for key, default, typ in _UPLOAD_SPEC
+            if key in kwargs or default is not None}
+    log.debug('Upload args: %r', args)
     return args
 
 
@@ -56,6 +90,10 @@ class Client(object):
         self.session = None
         self.apiurl = apiurl
 
+        # Keep-alive pool so login/upload reuse one connection to the API
+        self.http = requests.Session()
+        self.http.mount(apiurl, HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
     def get_url(self, service):
         return self.apiurl + service
 
@@ -67,11 +105,11 @@ class Client(object):
         if self.session is not None:
             args.update({'session': self.session})
 
-        print('Python:', args)
-        args_json = json.dumps(args)
-        print('Sending json:', args_json)
+        log.debug('Python: %r', args)
+        args_json = orjson.dumps(args)
+        log.debug('Sending json: %r', args_json)
         url = self.get_url(service)
-        print('Sending to URL:', url)
+        log.debug('Sending to URL: %s', url)
 
         if file_args is not None:
             import random
@@ -79,13 +117,14 @@ class Client(object):
             boundary = '===============%s==' % boundary_key
             headers = {'Content-Type':
                            'multipart/form-data; boundary="%s"' % boundary}
-            data_pre = (
+            json_pre = (
                     '--' + boundary + '\n' +
                     'Content-Type: text/plain\r\n' +
                     'MIME-Version: 1.0\r\n' +
                     'Content-disposition: form-data; name="request-json"\r\n' +
-                    '\r\n' +
-                    args_json + '\n' +
+                    '\r\n')
+            data_pre = (
+                    '\n' +
                     '--' + boundary + '\n' +
                     'Content-Type: application/octet-stream\r\n' +
                     'MIME-Version: 1.0\r\n' +
@@ -93,56 +132,58 @@ class Client(object):
                     '\r\n' + '\r\n')
             data_post = (
                     '\n' + '--' + boundary + '--\n')
-            data = data_pre.encode() + file_args[1] + data_post.encode()
+            # orjson already gives us bytes, so only the framing needs encoding.
+            # The file itself is read in chunks as the body is sent.
+            data = _MultipartBody(json_pre.encode() + args_json + data_pre.encode(),
+                                  file_args[1], data_post.encode())
 
         else:
-            # Else send x-www-form-encoded
+            # Else send x-www-form-encoded (requests encodes the dict)
             data = {'request-json': args_json}
-            print('Sending form data:', data)
-            data = urlencode(data)
-            data = data.encode('utf-8')
-            print('Sending data:', data)
+            log.debug('Sending form data: %r', data)
             headers = {}
 
-        request = Request(url=url, headers=headers, data=data)
-
         try:
-            f = urlopen(request)
-            txt = f.read()
-            print('Got json:', txt)
-            result = json.loads(txt)
-            print('Got result:', result)
+            r = self.http.post(url, headers=headers, data=data)
+            r.raise_for_status()
+            txt = r.content
+            log.debug('Got json: %r', txt)
+            result = orjson.loads(txt)
+            log.debug('Got result: %r', result)
             stat = result.get('status')
-            print('Got status:', stat)
+            log.debug('Got status: %s', stat)
             if stat == 'error':
                 errstr = result.get('errormessage', '(none)')
                 raise RequestError('server error message: ' + errstr)
             return result
-        except HTTPError as e:
-            print('HTTPError', e)
-            txt = e.read()
+        except requests.HTTPError as e:
+            log.error('HTTPError %s', e)
+            txt = e.response.content
             open('err.html', 'wb').write(txt)
-            print('Wrote error text to err.html')
+            log.error('Wrote error text to err.html')
 
     def login(self, apikey):
         args = {'apikey': apikey}
         result = self.send_request('login', args)
         sess = result.get('session')
-        print('Got session:', sess)
+        log.debug('Got session: %s', sess)
         if not sess:
             raise RequestError('no session in result')
         self.session = sess
 
-    def upload(self, fn=None, **kwargs):
-        args = _get_upload_args(**kwargs)
-        file_args = None
+    def upload(self, fn=None, args=None, **kwargs):
+        # Callers retrying an upload can pass pre-built args to skip rebuilding them
+        if args is None:
+            args = _get_upload_args(**kwargs)
 
-        if fn is not None:
-            try:
-                f = open(fn, 'rb')
-                file_args = (fn, f.read())
-            except IOError:
-                print('File %s does not exist' % fn)
-                raise
+        if fn is None:
+            return self.send_request('upload', args)
+
+        try:
+            f = open(fn, 'rb')
+        except IOError:
+            print('File %s does not exist' % fn)
+            raise
 
-        return self.send_request('upload', args, file_args)
+        with f:
+            return self.send_request('upload', args, (fn, f))
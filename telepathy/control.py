@@ -1,14 +1,22 @@
 import win32com.client as win
+import itertools
+import queue
+import subprocess
+import threading
 import time
 import numpy as np
 
-from astrometry import solve_web, solve_local
+from astrometry import solve_web, solve_local, solve_web_sources, solve_sources, extract_sources, UploadError
+from client import RequestError
 from pydantic import BaseModel, Field, PrivateAttr
 from typing import List, Any, Union, Optional
 from astropy.io import fits
 from pathlib import Path
 
 TIMEOUT = 30
+POLL_INTERVAL = 0.02
+LOGODDS_THRESHOLD = 21.0  # Minimum match log-odds to trust a solve (solve-field's default is ~20.7)
+MIN_SOURCES = 5  # Fewer stars than this can't be matched to an index quad
 
 class CameraError(Exception):
     pass
@@ -24,40 +32,53 @@ class Target(BaseModel):
     exposure_length: Optional[int] = None
     num_exposures: Optional[int] = None
 
+    @property
+    def ra_hr(self) -> float:
+        """RA in hours, as the mount expects it"""
+        return deg2hr(self.ra)
+
 
 def deg2hr(deg: float) -> float:
     """Convert degree to hour angle for RA"""
     return (deg / 360) * 24
 
-def pointing_error(ra: float, dec: float, target: Target) -> tuple:
-    """Determine pointing offset for a given target"""
-    ra_error, dec_error = abs(target.ra - ra), abs(target.dec - dec)
+def pointing_error(ra: float, dec: float, target_ra: Union[float, np.ndarray],
+                   target_dec: Union[float, np.ndarray]) -> tuple:
+    """Determine pointing offset for one target or an array of targets"""
+    # Wrap the RA difference into [-180, 180) so 359.9 vs 0.1 reads as 0.2
+    ra_error = np.abs(np.mod(target_ra - ra + 180, 360) - 180)
+    dec_error = np.abs(target_dec - dec)
     return (ra_error, dec_error)
 
-def within_tolerance(error: tuple, tol: float) -> bool:
+def within_tolerance(error: tuple, tol: float) -> Union[bool, np.ndarray]:
     """Determine if pointing error is within tolerance"""
     ra_error, dec_error = error
-    return (ra_error <= tol and dec_error <= tol)
+    return (ra_error <= tol) & (dec_error <= tol)
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Great-circle distance in degrees between points given in degrees (haversine)"""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    h = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))))
 
 
 def status_check(func):
-    """Run mount checks before slewing/syncing (possibly unnecessary)"""
+    """Wait for any slew in progress to finish before commanding the mount"""
     def wrapper(*args, **kwargs):
         tel = args[0].telescope
-        assert tel.CanPark
-        assert tel.CanSlew
-        assert not tel.Slewing
-        time.sleep(1)
+        start = time.time()
+        while tel.Slewing:
+            if time.time() - start > TIMEOUT:
+                raise TelescopeError(f"Telescope still slewing after {TIMEOUT} seconds")
+            time.sleep(0.05)
         func(*args, **kwargs)
-        time.sleep(5)
-        assert tel.CanSync
-        assert tel.CanSetTracking
     return wrapper
 
 
 class Session(BaseModel):
     apikey: str
-    image_path: Union[str, Path]
+    image_path: Path
     FOV_width: float
     targets: List[Target]
 
@@ -66,24 +87,45 @@ class Session(BaseModel):
     connect_focuser: bool = False
     connect_filter_wheel: bool = False
 
+    slew_settle: float = 0  # Seconds to let the mount settle after a slew
+    sync_settle: float = 0  # Seconds to wait after a sync
+
     camera: Any = None
     telescope: Any = None
     focuser: Any = None
     filter_wheel: Any = None
 
     _plate_solved: bool = PrivateAttr(False)
+    _save_queue: queue.Queue = PrivateAttr(default_factory=queue.Queue)
+    _writer: Optional[threading.Thread] = PrivateAttr(None)
+    _writer_error: Optional[Exception] = PrivateAttr(None)
+    _pixel_dtype: Any = PrivateAttr(np.int32)
+    _tracking: bool = PrivateAttr(False)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+        # COM objects stay on this thread; only the start-up waits of the two
+        # devices are overlapped
         if self.connect_camera:
             self.camera = self.camera_init()
         if self.connect_telescope:
             self.telescope = self.telescope_init()
+        self.wait_for_devices()
+
+        if self.connect_camera:
+            # ASCOM delivers Int32 pixels, but 16-bit sensors fit in half the memory
+            if self.camera.MaxADU <= np.iinfo(np.uint16).max:
+                self._pixel_dtype = np.uint16
+            # Frames are written to disk in the background so the next
+            # exposure can start as soon as the previous one is read out
+            self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer.start()
 
 
     def plate_solve(self, target: Optional[Target] = None, image_name: Union[str, Path] = "output.fits",
                     exp_time: float = 10, gain: int = 9, tol: float = 1 / 60, attempts: int = 3, web: bool = False):
+        self._plate_solved = False  # Only set once this target is confirmed within tolerance
 
         if target is None:
             try:
@@ -100,45 +142,102 @@ class Session(BaseModel):
         for i in range(attempts):
 
             print(f"Slewing to {label}...")
-            self.slew_telescope(ra=target.ra, dec=target.dec)
-            self.take_image(duration=exp_time, gain=gain, output=image_name)
-
-            if web:
-                solution = solve_web(
-                    img_filename=image_name,
-                    api_key=self.apikey,
-                    ra=target.ra,
-                    dec=target.dec,
-                    radius=self.FOV_width * 0.75
-                )
-            else:
-                solution = solve_local(
-                    img_filename=image_name,
-                    ra=target.ra,
-                    dec=target.dec,
-                    radius=self.FOV_width * 0.75
-                )
+            self.slew_telescope(ra_hr=target.ra_hr, dec=target.dec)
+            try:
+                image = self.take_image(duration=exp_time, gain=gain, output=image_name)
+            except (TimeoutError, CameraError) as e:
+                print(f"{e}, skipping {label}...")
+                break
+
+            # Solve from the frame still in memory rather than re-reading it from disk;
+            # either solver only needs the star list, not the pixels
+            xs, ys, flux = extract_sources(image)
+            # Clouds, dew or a capped lens leave nothing to solve from
+            if len(xs) < MIN_SOURCES:
+                print(f"Only {len(xs)} stars detected, skipping {label}...")
+                break
+
+            try:
+                if web:
+                    solution = solve_web_sources(
+                        xs, ys,
+                        width=image.shape[1],
+                        height=image.shape[0],
+                        api_key=self.apikey,
+                        ra=target.ra,
+                        dec=target.dec,
+                        radius=self.FOV_width * 0.75
+                    )
+                else:
+                    # FOV_width is measured along the sensor's NumX axis, i.e. image.shape[1]
+                    solution = solve_sources(
+                        xs, ys, flux,
+                        width=image.shape[1],
+                        height=image.shape[0],
+                        ra=target.ra,
+                        dec=target.dec,
+                        radius=self.FOV_width * 0.75,
+                        fov_width=self.FOV_width
+                    )
+
+                if solution is None:
+                    # Fall back to letting the solver detect stars in the saved frame itself
+                    print("Star list solve failed, solving from the saved image...")
+                    self.flush_images()
+                    if web:
+                        solution = solve_web(str(image_name), self.apikey, ra=target.ra, dec=target.dec,
+                                             radius=self.FOV_width * 0.75)
+                    else:
+                        solution = solve_local(str(image_name), ra=target.ra, dec=target.dec,
+                                               radius=self.FOV_width * 0.75)
+            except (subprocess.CalledProcessError, RequestError, UploadError, TimeoutError) as e:
+                print(f"Solver error: {e}, skipping {label}...")
+                break
 
             if solution is None:
                 print("Plate solving failed, aborting...")
                 break
 
             pointing_ra, pointing_dec = solution["ra"], solution["dec"]
-            error = pointing_error(pointing_ra, pointing_dec, target)
+            error = pointing_error(pointing_ra, pointing_dec, target.ra, target.dec)
 
             print(f"Pointing error - RA: {round(error[0], 4)}, DEC: {round(error[1], 4)}")
-            print("Syncing...")
 
-            self.sync_telescope(ra=pointing_ra, dec=pointing_dec)
+            logodds = solution["logodds"]
+            if logodds is not None:
+                print(f"Match log-odds: {round(logodds, 1)}")
+                # Neither sync on nor accept a match the solver itself is unsure of
+                if logodds < LOGODDS_THRESHOLD:
+                    print("Match confidence too low, retrying...")
+                    continue
+
+            # Already on target: no sync, re-slew or extra frame needed
             if within_tolerance(error, tol):
                 print(f"Plate solve succeeded in {i + 1} attempt" + ("s" if i > 0 else ""))
                 self._plate_solved = True
                 break
-            elif i == attempts - 1:
-                print("Attempt limit reached, aborting...")
 
-    def take_image(self, duration: float, gain: int, output: Union[Path, str] = "output.fits"):
-        if self.camera.Connected and self.camera.CameraState == 0:  # Camera state 0 implies camera is idle
+            print("Syncing...")
+            self.sync_telescope(ra_hr=deg2hr(pointing_ra), dec=pointing_dec)
+        else:
+            print("Attempt limit reached, aborting...")
+
+        self.flush_images()
+
+    def target_coords(self) -> tuple:
+        """RA and Dec of the current target list, as arrays"""
+        # Built on each call since targets is a public list that may have changed
+        ra = np.fromiter((t.ra for t in self.targets), dtype=np.float64, count=len(self.targets))
+        dec = np.fromiter((t.dec for t in self.targets), dtype=np.float64, count=len(self.targets))
+        return ra, dec
+
+    def pointing_errors(self, ra: float, dec: float) -> tuple:
+        """Pointing offset from (ra, dec) to every target, as arrays"""
+        return pointing_error(ra, dec, *self.target_coords())
+
+    def take_image(self, duration: float, gain: int, output: Union[Path, str] = "output.fits",
+                   compress: bool = False) -> np.ndarray:
+        if self.camera.Connected and self.wait_for_idle():
             self.camera.Gain = gain
             print(f"Taking {duration} second exposure at ISO {list(self.camera.Gains)[gain]}")
             self.camera.StartExposure(duration, True)
@@ -147,37 +246,140 @@ class Session(BaseModel):
 
             while True:
                 if time.time() - start > TIMEOUT:
+                    # Abort so the next exposure doesn't start behind a stuck one
+                    state = self.camera.CameraState
                     if self.camera.CanAbortExposure:
                         self.camera.AbortExposure()
-                    raise TimeoutError
+                        self.wait_for_idle()
+                    raise TimeoutError(f"Image not ready after {TIMEOUT} seconds (camera state {state})")
 
                 if self.camera.ImageReady:
-                    self.save_image(output)
-                    break
-                time.sleep(1)
+                    return self.save_image(output, compress=compress)
+                time.sleep(POLL_INTERVAL)
         else:
             raise CameraError("Process failed: Camera unavailable for exposure")
 
-    def save_image(self, output: Union[Path, str]):
+    def wait_for_idle(self, timeout: float = TIMEOUT) -> bool:
+        """Wait for the camera to go idle (e.g. after an abort), returning whether it did"""
+        start = time.time()
+        while self.camera.CameraState != 0:  # Camera state 0 implies camera is idle
+            if time.time() - start > timeout:
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def save_image(self, output: Union[Path, str], compress: bool = False) -> Optional[np.ndarray]:
         if not self.camera.ImageReady:
             print("No image to be saved")
             return
 
+        self._raise_writer_error()
         print(f"Saving image to {output}")
-        img = self.camera.ImageArray
-        newhdu = fits.PrimaryHDU(np.array(img))
-        newhdu.writeto(output, overwrite=True)
-        print("Image successfully saved")
+        # pywin32 hands back ImageArray as a tuple of tuples; feeding the flattened
+        # rows to fromiter avoids np.array's nested-sequence inference
+        raw = self.camera.ImageArray
+        shape = (len(raw), len(raw[0]))
+        img = np.fromiter(itertools.chain.from_iterable(raw), dtype=self._pixel_dtype,
+                          count=shape[0] * shape[1]).reshape(shape)
+        # ASCOM indexes ImageArray as [NumX][NumY]; transpose to numpy's (rows, cols)
+        # so shape[1] is the sensor width, as FITS and the solvers expect
+        img = np.ascontiguousarray(img.T)
+        self._save_queue.put((img, output, compress))
+        return img
+
+    def _writer_loop(self):
+        while True:
+            img, output, compress = self._save_queue.get()
+            try:
+                if compress:
+                    # Lossless Rice tiles cut the integer frame to roughly a third on disk
+                    newhdu = fits.HDUList([fits.PrimaryHDU(),
+                                           fits.CompImageHDU(img, compression_type="RICE_1", tile_shape=(128, 128))])
+                else:
+                    newhdu = fits.PrimaryHDU(img)
+                newhdu.writeto(output, overwrite=True, output_verify="ignore")
+                print(f"Image successfully saved to {output}")
+            except Exception as e:
+                # Keep the first failure (e.g. a full disk) for the main thread to raise
+                print(f"Failed to save image to {output}: {e}")
+                if self._writer_error is None:
+                    self._writer_error = e
+            finally:
+                self._save_queue.task_done()
+
+    def flush_images(self):
+        """Block until every queued frame is on disk, raising any write failure"""
+        self._save_queue.join()
+        self._raise_writer_error()
+
+    def _raise_writer_error(self):
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
 
     def shoot_target(self, target: Target, terminate: bool = False):
-        prefix = target.name.lower().replace(" ", "_")
-
-        for i in range(target.num_exposures):
-            print(f"Image {i+1} of {target.num_exposures}")
-            self.take_image(duration=target.exposure_length, gain=9, output=f"{self.image_path}{prefix}{i}.fits")
+        base = self.image_path / target.name.lower().replace(" ", "_")
+
+        try:
+            for i in range(target.num_exposures):
+                print(f"Image {i+1} of {target.num_exposures}")
+                output = base.with_name(f"{base.name}{i}.fits")
+                try:
+                    self.take_image(duration=target.exposure_length, gain=9, output=output, compress=True)
+                except (TimeoutError, CameraError) as e:
+                    print(f"{e}, skipping {target.name}...")
+                    break
 
-        if terminate:
-            self.end_session()
+            # The writer is a daemon thread, so don't return with subs still queued
+            self.flush_images()
+        finally:
+            # Park even if a frame failed to write
+            if terminate:
+                self.end_session()
+
+    def plan_tour(self) -> np.ndarray:
+        """Order targets by greedy nearest neighbour, starting from the current mount pointing"""
+        n = len(self.targets)
+        if n == 0:
+            return np.empty(0, dtype=int)
+
+        targets_ra, targets_dec = self.target_coords()
+        if self.telescope is not None:
+            ra, dec = self.telescope.RightAscension * 15, self.telescope.Declination
+        else:
+            ra, dec = targets_ra[0], targets_dec[0]
+
+        # Pairwise separations are O(N^2), which is fine for a night's target list
+        dist = angular_separation(targets_ra[:, None], targets_dec[:, None],
+                                  targets_ra[None, :], targets_dec[None, :])
+        remaining = np.ones(n, dtype=bool)
+        order = np.empty(n, dtype=int)
+        current = angular_separation(ra, dec, targets_ra, targets_dec)
+        for i in range(n):
+            nxt = int(np.argmin(np.where(remaining, current, np.inf)))
+            order[i] = nxt
+            remaining[nxt] = False
+            current = dist[nxt]
+        return order
+
+    def shoot_all(self, terminate: bool = False):
+        """Plate solve and image every target in slew-optimised order"""
+        # Plan from the live target list and current pointing; iterate over a
+        # snapshot so the order and the targets it indexes can't drift apart
+        targets = list(self.targets)
+        try:
+            for i in self.plan_tour():
+                target = targets[i]
+                self.plate_solve(target)
+                # Don't spend a full set of subs at an unconfirmed pointing
+                if not self._plate_solved:
+                    print(f"Plate solve failed for {target.name}, skipping...")
+                    continue
+                self.shoot_target(target)
+        finally:
+            # Park even if a frame failed to write
+            if terminate:
+                self.end_session()
 
     def name_to_ind(self, name):
         for i, target in enumerate(self.targets):
@@ -185,28 +387,34 @@ class Session(BaseModel):
                 return i
 
     @status_check
-    def slew_telescope(self, ra: float, dec: float):
-        """RA and Dec should both be in degrees"""
+    def slew_telescope(self, ra_hr: float, dec: float):
+        """RA should be in hours and Dec in degrees"""
         if self.telescope.AtPark:
             self.telescope.Unpark()
+            self._tracking = False
             print("Telescope Unparked")
 
-        ra = deg2hr(ra)
-        self.telescope.SlewToCoordinates(ra, dec)
-        if not self.telescope.Tracking:
-            self.telescope.Tracking = True
+        self.telescope.SlewToCoordinates(ra_hr, dec)
+        self.ensure_tracking()
+        time.sleep(self.slew_settle)
 
     @status_check
-    def sync_telescope(self, ra: float, dec: float):
-        """RA and Dec should both be in degrees"""
-        ra = deg2hr(ra)
-        if not self.telescope.Tracking:
+    def sync_telescope(self, ra_hr: float, dec: float):
+        """RA should be in hours and Dec in degrees"""
+        self.ensure_tracking()
+        self.telescope.SyncToCoordinates(ra_hr, dec)
+        time.sleep(self.sync_settle)
+
+    def ensure_tracking(self):
+        """Turn tracking on, skipping the COM round-trip when we already did so"""
+        if not self._tracking:
             self.telescope.Tracking = True
-        self.telescope.SyncToCoordinates(ra, dec)
+            self._tracking = True
 
     @status_check
     def park_telescope(self) -> None:
         self.telescope.Park()
+        self._tracking = False  # Parking stops tracking
 
         # Telescope.Park() is asynchronous, wait for it to finish
         # before continuing
@@ -215,32 +423,65 @@ class Session(BaseModel):
 
 
     def end_session(self):
-        if self.camera.CameraState != 0:
-            self.camera.AbortExposure()
-        if not self.telescope.AtPark:
-            self.park_telescope()
-        self.telescope.connected = False
-        self.camera.connected = False
-        print("Session ended: Telescope has been parked. Camera and telescope have disconnected")
-
+        try:
+            self.flush_images()  # Finish writing any queued frames
+        finally:
+            # A failed write must not leave the mount unparked
+            if self.camera.CameraState != 0:
+                self.camera.AbortExposure()
+            if not self.telescope.AtPark:
+                self.park_telescope()
+            self.telescope.Connected = False
+            self.camera.Connected = False
+            print("Session ended: Telescope has been parked. Camera and telescope have disconnected")
+
+
+    def wait_for_devices(self):
+        """Finish the camera warm-up frame and wait for the mount to be ready, concurrently"""
+        start = time.time()
+        warming_up = self.camera is not None
+        mount_starting = self.telescope is not None
+
+        while warming_up or mount_starting:
+            if warming_up and self.camera.ImageReady:
+                self.camera.ImageArray  # Discard the warm-up frame
+                warming_up = False
+            elif warming_up and time.time() - start > TIMEOUT:
+                raise CameraError("Camera warm-up frame timed out")
+
+            # Give the mount up to 3 seconds to report it is ready to slew
+            if mount_starting and (self.telescope.CanSlew or time.time() - start > 3):
+                mount_starting = False
+
+            if warming_up or mount_starting:
+                time.sleep(POLL_INTERVAL)
+
+        if self.telescope is not None:
+            # Mount capabilities are fixed, so check them once here rather than per command
+            for cap in ("CanPark", "CanSlew", "CanSync", "CanSetTracking"):
+                if not getattr(self.telescope, cap):
+                    raise TelescopeError(f"Telescope does not support {cap[3:]}")
 
     @staticmethod
     def camera_init():
-        cam = win.Dispatch("ASCOM.DSLR.Camera")
+        cam = win.gencache.EnsureDispatch("ASCOM.DSLR.Camera")
         cam.Connected = True
         if cam.Connected:
             print("Camera connected")
+
+            # Start a shortest-possible dark so the driver's cold-start cost isn't
+            # paid by the first real exposure; wait_for_devices reads and discards it
+            cam.StartExposure(cam.ExposureMin, False)
             return cam
         else:
             raise ConnectionError("Camera failed to connect")
 
     @staticmethod
     def telescope_init():
-        tel = win.Dispatch("EQMOD.Telescope")
+        tel = win.gencache.EnsureDispatch("EQMOD.Telescope")
         tel.Connected = True
         if tel.Connected:
             print("Telescope connected")
-            time.sleep(3)
             return tel
         else:
             raise ConnectionError("Telescope failed to connect")